@@ -1,183 +1,1110 @@
+import array
+import ctypes
+import functools
+import mmap
+import platform
+import sys
 import unittest
 from dataclasses import dataclass
+from typing import Callable, ClassVar, Iterable, TypeVar, Union
 
+try:
+    from rsc_regex_vm import match_c
+except ImportError:
+    match_c = None
 
-@dataclass
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class _CallRecursionError(Exception):
+    "Carries a RecursionError raised by a memoized function past _memoize."
+
+    def __init__(self, error: RecursionError) -> None:
+        super().__init__(error)
+        self.error = error
+
+
+def _memoize(function: Callable[[K], V]) -> Callable[[K], V]:
+    """functools.lru_cache for a function of one argument, falling back to an
+    uncached call when the argument is nested too deeply to hash or compare."""
+
+    def call(arg: K) -> V:
+        try:
+            return function(arg)
+        except RecursionError as error:
+            raise _CallRecursionError(error) from None
+
+    cached = functools.lru_cache(maxsize=1024)(call)
+
+    @functools.wraps(function)
+    def wrapper(arg: K) -> V:
+        try:
+            return cached(arg)
+        except RecursionError:
+            # Raised by the cache lookup, before function ran.
+            return function(arg)
+        except _CallRecursionError as wrapped:
+            raise wrapped.error from None
+
+    return wrapper
+
+
+@dataclass(frozen=True, slots=True)
 class Expr:
     pass
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Lit(Expr):
     value: str
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Seq(Expr):
     left: Expr
     right: Expr
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Alt(Expr):
     left: Expr
     right: Expr
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Maybe(Expr):
     expr: Expr
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Star(Expr):
     expr: Expr
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Plus(Expr):
     expr: Expr
 
 
-@dataclass
+# Opcode tags, used by compile_to_arrays and the VMs that run its output.
+CHAR = 0
+MATCH = 1
+JUMP = 2
+SPLIT = 3
+CHAR_STAR = 4
+CHAR_RUN = 5
+
+
+@dataclass(frozen=True, slots=True)
 class Opcode:
-    pass
+    tag: ClassVar[int] = -1
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Char(Opcode):
+    tag = CHAR
+    value: str
+
+
+@dataclass(frozen=True, slots=True)
+class CharStar(Opcode):
+    "zero or more of value; equivalent to split, char, jmp back"
+    tag = CHAR_STAR
     value: str
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
+class CharRun(Opcode):
+    "count (at least two) copies of value; equivalent to that many chars"
+    tag = CHAR_RUN
+    value: str
+    count: int
+
+
+@dataclass(frozen=True, slots=True)
 class Match(Opcode):
-    pass
+    tag = MATCH
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Jump(Opcode):
     "relative displacement"
+    tag = JUMP
     target: int
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Split(Opcode):
     "relative displacements"
+    tag = SPLIT
     target1: int
     target2: int
 
 
-def compile(expr: Expr) -> list[Opcode]:
-    if isinstance(expr, Lit):
-        assert len(expr.value) == 1, "Only single character literals are supported"
-        return [Char(expr.value)]
-    if isinstance(expr, Seq):
-        return compile(expr.left) + compile(expr.right)
-    if isinstance(expr, Alt):
-        """
-        left|right
-                            split L1, L2
-                        L1: codes for left
-                            jmp L3
-                        L2: codes for right
-                        L3:
-        """
-        left = compile(expr.left)
-        right = compile(expr.right)
-        return [
-            Split(0, len(left) + 1),
-            *left,
-            Jump(len(right) + 1),
-            *right,
-        ]
-    raise NotImplementedError(f"Unsupported expression: {expr}")
-
-
-@dataclass
-class Thread:
-    pc: int
-    textp: int
-
+# A compile work item: an expression to emit, or a step to run once everything
+# pushed after it has been emitted (used to back-patch displacements).
+WorkItem = Union[Expr, Callable[[], None]]
 
-MAX_THREADS = 10
 
+def compile(expr: Expr) -> list[Opcode]:
+    # The cached program is shared, so hand out a copy.
+    return list(_compile(expr))
+
+
+@_memoize
+def _compile(expr: Expr) -> tuple[Opcode, ...]:
+    out: list[Opcode] = []
+    work: list[WorkItem] = [expr]
+    while work:
+        match work.pop():
+            case Lit(value):
+                assert len(value) == 1, "Only single character literals are supported"
+                out.append(Char(value))
+            case Seq(left, right):
+                work += [right, left]
+            case Alt() as item:
+                work += _compile_alt(item, out)
+            case Star(Lit(value)):
+                assert len(value) == 1
+                out.append(CharStar(value))
+            case Star() as item:
+                work += _compile_star(item, out)
+            case Plus(Lit() as lit):
+                work += [Star(lit), lit]
+            case Plus() as item:
+                work += _compile_plus(item, out)
+            case Maybe() as item:
+                work += _compile_maybe(item, out)
+            case Expr() as item:
+                raise NotImplementedError(f"Unsupported expression: {item}")
+            case patch:
+                patch()
+    return tuple(coalesce_char_runs(out))
+
+
+def _compile_alt(expr: Alt, out: list[Opcode]) -> list[WorkItem]:
+    """
+    left|right
+                        split L1, L2
+                    L1: codes for left
+                        jmp L3
+                    L2: codes for right
+                    L3:
+
+    Emits the split and returns the remaining work, last item first.
+    """
+    out.append(Split(0, 0))
+    split_pc = len(out)
+    jump_pc = 0
+
+    def emit_jump() -> None:
+        nonlocal jump_pc
+        out.append(Jump(0))
+        jump_pc = len(out)
+        out[split_pc - 1] = Split(0, jump_pc - split_pc)
+
+    def patch_jump() -> None:
+        out[jump_pc - 1] = Jump(len(out) - jump_pc)
+
+    return [patch_jump, expr.right, emit_jump, expr.left]
+
+
+def _compile_star(expr: Star, out: list[Opcode]) -> list[WorkItem]:
+    """
+    expr*
+                    L1: split L2, L3
+                    L2: codes for expr
+                        jmp L1
+                    L3:
+    """
+    out.append(Split(0, 0))
+    split_pc = len(out)
+
+    def emit_jump() -> None:
+        jump_pc = len(out) + 1
+        out.append(Jump(split_pc - 1 - jump_pc))
+        out[split_pc - 1] = Split(0, jump_pc - split_pc)
+
+    return [emit_jump, expr.expr]
+
+
+def _compile_plus(expr: Plus, out: list[Opcode]) -> list[WorkItem]:
+    """
+    expr+
+                    L1: codes for expr
+                        split L1, L2
+                    L2:
+    """
+    start = len(out)
+
+    def emit_split() -> None:
+        out.append(Split(start - (len(out) + 1), 0))
+
+    return [emit_split, expr.expr]
+
+
+def _compile_maybe(expr: Maybe, out: list[Opcode]) -> list[WorkItem]:
+    """
+    expr?
+                        split L1, L2
+                    L1: codes for expr
+                    L2:
+    """
+    out.append(Split(0, 0))
+    split_pc = len(out)
+
+    def patch_split() -> None:
+        out[split_pc - 1] = Split(0, len(out) - split_pc)
+
+    return [patch_split, expr.expr]
+
+
+def _jump_targets(ops: list[Opcode]) -> set[int]:
+    "Absolute pcs that a Jump or Split can land on."
+    targets = set()
+    for pc, op in enumerate(ops, 1):
+        match op:
+            case Jump(target):
+                targets.add(pc + target)
+            case Split(target1, target2):
+                targets.add(pc + target1)
+                targets.add(pc + target2)
+    return targets
+
+
+def _relocate(ops: list[Opcode], new_pcs: list[int], out: list[Opcode]) -> None:
+    """Rewrite the displacements of the Jumps and Splits copied into out.
+
+    new_pcs[pc] is where ops[pc] (or the code replacing it) starts in out, for
+    every pc in range(len(ops) + 1). Jumps and Splits must be copied one to
+    one.
+    """
+    nops = len(ops)
+
+    def new_target(pc: int, target: int) -> int:
+        return new_pcs[min(max(pc + 1 + target, 0), nops)] - (new_pcs[pc] + 1)
 
-def run_thread(ops: list[Opcode], text: str, threads: list[Thread]) -> bool:
-    thread = threads.pop()
-    pc = thread.pc
-    textp = thread.textp
-    while pc < len(ops):
+    for pc, op in enumerate(ops):
+        match op:
+            case Jump(target):
+                out[new_pcs[pc]] = Jump(new_target(pc, target))
+            case Split(target1, target2):
+                out[new_pcs[pc]] = Split(
+                    new_target(pc, target1), new_target(pc, target2)
+                )
+
+
+def coalesce_char_runs(ops: list[Opcode]) -> list[Opcode]:
+    """Fold runs of identical Chars into CharRuns.
+
+    A run is never extended over a pc that a Jump or Split lands on.
+    """
+    targets = _jump_targets(ops)
+    nops = len(ops)
+    new_pcs = [0] * (nops + 1)
+    out: list[Opcode] = []
+    pc = 0
+    while pc < nops:
         op = ops[pc]
-        pc += 1
+        end = pc + 1
         if isinstance(op, Char):
-            if textp >= len(text) or text[textp] != op.value:
-                return False
-            textp += 1
-        elif isinstance(op, Jump):
-            pc += op.target
-        elif isinstance(op, Match):
-            return True
-        elif isinstance(op, Split):
-            if len(threads) >= MAX_THREADS:
-                raise RuntimeError("Too many threads")
-            threads.append(Thread(pc + op.target2, textp))
-            pc += op.target1
-        else:
+            while end < nops and ops[end] == op and end not in targets:
+                end += 1
+        for old_pc in range(pc, end):
+            new_pcs[old_pc] = len(out)
+        out.append(op if end == pc + 1 else CharRun(op.value, end - pc))
+        pc = end
+    new_pcs[nops] = len(out)
+    _relocate(ops, new_pcs, out)
+    return out
+
+
+def _expand_char_runs(ops: list[Opcode]) -> list[Opcode]:
+    "Undo coalesce_char_runs, for consumers that only handle single Chars."
+    nops = len(ops)
+    new_pcs = [0] * (nops + 1)
+    out: list[Opcode] = []
+    for pc, op in enumerate(ops):
+        new_pcs[pc] = len(out)
+        match op:
+            case CharRun(value, count):
+                out += [Char(value)] * count
+            case _:
+                out.append(op)
+    new_pcs[nops] = len(out)
+    _relocate(ops, new_pcs, out)
+    return out
+
+
+def compile_to_arrays(
+    ops: list[Opcode],
+) -> tuple[array.array, array.array, array.array]:
+    """Lower ops into three parallel arrays: tag, arg1, arg2.
+
+    Jump and Split displacements are resolved to absolute pcs so the VM does
+    not have to add them at run time; targets are clamped to [0, len(ops)],
+    as in _relocate and native_compile. A MATCH is appended at len(ops) so
+    that running off the end of the program needs no bounds check. Char and
+    CharStar store their code point in arg1 and the pc to continue at after
+    consuming it in arg2. CharRun stores its code point in arg1 and minus its
+    count in arg2.
+    """
+    nops = len(ops)
+    tags = array.array("b", bytes(nops + 1))
+    arg1 = array.array("i", [0]) * (nops + 1)
+    arg2 = array.array("i", [0]) * (nops + 1)
+    tags[nops] = MATCH
+    for pc, op in enumerate(ops):
+        tag = op.tag
+        if tag == CHAR:
+            arg1[pc] = ord(op.value)
+            arg2[pc] = pc + 1
+        elif tag == CHAR_STAR:
+            arg1[pc] = ord(op.value)
+            arg2[pc] = pc
+        elif tag == CHAR_RUN:
+            assert op.count > 1, "CharRun needs at least two characters"
+            arg1[pc] = ord(op.value)
+            arg2[pc] = -op.count
+        elif tag == JUMP:
+            arg1[pc] = max(0, min(pc + 1 + op.target, nops))
+        elif tag == SPLIT:
+            arg1[pc] = max(0, min(pc + 1 + op.target1, nops))
+            arg2[pc] = max(0, min(pc + 1 + op.target2, nops))
+        elif tag != MATCH:
             raise NotImplementedError(f"Unsupported opcode: {op}")
-    return True
+        tags[pc] = tag
+    return tags, arg1, arg2
+
+
+def _text_buffer(text: str) -> memoryview:
+    """Return text as a buffer whose items are code points (ints), so reading
+    a character is an int load rather than a 1-character str."""
+    try:
+        return memoryview(text.encode("latin-1"))
+    except UnicodeEncodeError:
+        return memoryview(text.encode("utf-32-le")).cast("I")
+
+
+def _addstate(
+    tags: array.array,
+    arg1: array.array,
+    arg2: array.array,
+    states: list[int],
+    on: bytearray,
+    stack: list[int],
+    pc: int,
+) -> bool:
+    """Add the pcs of consuming ops reachable from pc without consuming input
+    to states.
+
+    Returns True if a Match is reachable. stack is scratch space of at least
+    len(tags) entries; pcs are marked in on as they are pushed, so each is
+    pushed at most once.
+    """
+    if on[pc]:
+        return False
+    on[pc] = 1
+    stack[0] = pc
+    sp = 1
+    while sp:
+        sp -= 1
+        pc = stack[sp]
+        tag = tags[pc]
+        # Ordered by how often each tag shows up: a Char or Split per
+        # alternative or loop body, a Jump per Alt and Star, and at most one
+        # Match per program.
+        if tag == CHAR:
+            states.append(pc)
+        elif tag == SPLIT:
+            target = arg2[pc]
+            if not on[target]:
+                on[target] = 1
+                stack[sp] = target
+                sp += 1
+            target = arg1[pc]
+            if not on[target]:
+                on[target] = 1
+                stack[sp] = target
+                sp += 1
+        elif tag == JUMP:
+            target = arg1[pc]
+            if not on[target]:
+                on[target] = 1
+                stack[sp] = target
+                sp += 1
+        elif tag == CHAR_STAR:
+            states.append(pc)
+            target = pc + 1
+            if not on[target]:
+                on[target] = 1
+                stack[sp] = target
+                sp += 1
+        elif tag == CHAR_RUN:
+            states.append(pc)
+        else:
+            return True
+    return False
+
+
+def _extract_prefix(ops: list[Opcode]) -> tuple[str, list[Opcode]]:
+    """Split ops into the literal that every match must start with and the
+    rest of the program.
+
+    The prefix is the leading run of Chars and CharRuns, cut short before any
+    pc that a Jump or Split can land on so that the rest of the program runs
+    the same way on its own.
+    """
+    end = 0
+    while end < len(ops) and isinstance(ops[end], (Char, CharRun)):
+        end += 1
+    end = min([end, *(max(target, 0) for target in _jump_targets(ops))])
+    prefix = "".join(
+        op.value * op.count if isinstance(op, CharRun) else op.value
+        for op in ops[:end]
+    )
+    return prefix, ops[end:]
 
 
 def match(ops: list[Opcode], text: str) -> bool:
-    threads = [Thread(pc=0, textp=0)]
-    while threads:
-        result = run_thread(ops, text, threads)
-        if result:
+    """Thompson-style simulation: advance every live thread in lockstep, one
+    character at a time, so matching is linear in len(ops) * len(text)."""
+    recent = _recent.get(id(ops))
+    # Comparing against the copy is a pointer comparison per op, and catches
+    # a program that was modified in place since it was prepared.
+    if recent is not None and recent[0] is ops and recent[1] == ops:
+        prepared = recent[2]
+    else:
+        prepared = _prepare(tuple(ops))
+        if len(_recent) >= MAX_RECENT:
+            # Another thread may evict the same entry first.
+            _recent.pop(next(iter(_recent), None), None)
+        _recent[id(ops)] = (ops, ops[:], prepared)
+    prefix, tags, arg1, arg2, states = prepared
+    # One C-level comparison instead of a VM step per character.
+    if prefix and not text.startswith(prefix):
+        return False
+    if states is None:
+        return True
+    if match_c is not None:
+        try:
+            buf = text.encode("latin-1")
+        except UnicodeEncodeError:
+            pass
+        else:
+            return match_c(tags, arg1, arg2, buf, len(prefix))
+    return _match_arrays(tags, arg1, arg2, text, len(prefix), states)
+
+
+Prepared = tuple[str, array.array, array.array, array.array, tuple[int, ...] | None]
+
+# The programs last passed to match, by id: the program itself (which also
+# keeps the id from being reused), a copy of it, and its prepared form.
+# Hashing a program means hashing every op, so this is checked first.
+MAX_RECENT = 64
+_recent: dict[int, tuple[list[Opcode], list[Opcode], Prepared]] = {}
+
+
+@_memoize
+def _prepare(ops: tuple[Opcode, ...]) -> Prepared:
+    """The literal prefix of ops, the lowered arrays for the rest of it, and
+    the rest's start states."""
+    prefix, rest = _extract_prefix(list(ops))
+    tags, arg1, arg2 = compile_to_arrays(rest)
+    return prefix, tags, arg1, arg2, _start_states(tags, arg1, arg2)
+
+
+def _start_states(
+    tags: array.array, arg1: array.array, arg2: array.array
+) -> tuple[int, ...] | None:
+    "The closure of pc 0, or None if it reaches a Match."
+    size = len(tags)
+    states: list[int] = []
+    if _addstate(tags, arg1, arg2, states, bytearray(size), [0] * size, 0):
+        return None
+    return tuple(states)
+
+
+def _match_arrays(
+    tags: array.array,
+    arg1: array.array,
+    arg2: array.array,
+    text: str,
+    start: int = 0,
+    states: tuple[int, ...] | None = None,
+) -> bool:
+    """Run the program from pc 0 against text[start:].
+
+    states, if given, is the non-None result of _start_states, which match
+    caches.
+    """
+    if states is None:
+        states = _start_states(tags, arg1, arg2)
+        if states is None:
             return True
+    size = len(tags)
+    addstate = _addstate
+    stack = [0] * size
+    # A thread that gets through a CharRun resumes several characters ahead;
+    # pending maps that text position to the pcs to resume there.
+    pending: dict[int, list[int]] = {}
+    clist: Iterable[int] = states
+    # For short texts, indexing the str is cheaper than encoding it first.
+    for textp in range(start, len(text)):
+        ch = ord(text[textp])
+        nlist: list[int] = []
+        on = bytearray(size)
+        for pc in clist:
+            if arg1[pc] != ch:
+                continue
+            next_pc = arg2[pc]
+            if next_pc >= 0:
+                # The closure of a Char is itself; skip the call.
+                if tags[next_pc] == CHAR:
+                    if not on[next_pc]:
+                        on[next_pc] = 1
+                        nlist.append(next_pc)
+                elif addstate(tags, arg1, arg2, nlist, on, stack, next_pc):
+                    return True
+            elif text.count(chr(ch), textp, textp - next_pc) == -next_pc:
+                pending.setdefault(textp - next_pc, []).append(pc + 1)
+        if pending:
+            for pc in pending.pop(textp + 1, ()):
+                if addstate(tags, arg1, arg2, nlist, on, stack, pc):
+                    return True
+        if not nlist and not pending:
+            return False
+        clist = nlist
     return False
 
 
-def native_compile(ops: list[Opcode]) -> str:
-    # TODO(max): Add outer loop that pops threads from the stack and runs them
-    # TODO(max): Add prologue
-    # TODO(max): Add epilogue
-    result: list[str] = []
+DFA = tuple[list[dict[int, int]], list[bool]]
+
+
+def to_dfa(ops: list[Opcode]) -> DFA:
+    """Subset construction over the epsilon closures of Jump/Split.
+
+    Each DFA state is a set of live Char/CharStar pcs. trans[state] maps a code
+    point to the next state; a missing entry means the match fails. All
+    accepting states are merged into one since matching stops as soon as it is
+    reached. State 0 is the start state.
+
+    The result is cached and shared between callers with equal programs.
+    """
+    return _to_dfa(tuple(ops))
+
+
+@_memoize
+def _to_dfa(ops: tuple[Opcode, ...]) -> DFA:
+    tags, arg1, arg2 = compile_to_arrays(_expand_char_runs(list(ops)))
+    size = len(tags)
+    stack = [0] * size
+    start: list[int] = []
+    if _addstate(tags, arg1, arg2, start, bytearray(size), stack, 0):
+        return [{}], [True]
+    trans: list[dict[int, int]] = [{}]
+    accept = [False]
+    ids: dict[frozenset[int] | None, int] = {frozenset(start): 0}
+    worklist = [(0, frozenset(start))]
+    while worklist:
+        state, pcs = worklist.pop()
+        for ch in dict.fromkeys(arg1[pc] for pc in pcs):
+            key = _dfa_next(tags, arg1, arg2, stack, pcs, ch)
+            if key is not None and not key:
+                continue
+            if key not in ids:
+                ids[key] = len(trans)
+                trans.append({})
+                accept.append(key is None)
+                if key is not None:
+                    worklist.append((ids[key], key))
+            trans[state][ch] = ids[key]
+    return trans, accept
+
+
+def _dfa_next(
+    tags: array.array,
+    arg1: array.array,
+    arg2: array.array,
+    stack: list[int],
+    pcs: frozenset[int],
+    ch: int,
+) -> frozenset[int] | None:
+    """The DFA state after pcs consume ch: the closure of whatever follows
+    each of them that matches ch. None if that reaches a Match; empty if the
+    match fails."""
+    nlist: list[int] = []
+    on = bytearray(len(tags))
+    for pc in pcs:
+        if arg1[pc] == ch and _addstate(tags, arg1, arg2, nlist, on, stack, arg2[pc]):
+            return None
+    return frozenset(nlist)
+
+
+def match_dfa(dfa: DFA, text: str) -> bool:
+    trans, accept = dfa
+    state = 0
+    if accept[state]:
+        return True
+    for ch in _text_buffer(text):
+        next_state = trans[state].get(ch)
+        if next_state is None:
+            return False
+        if accept[next_state]:
+            return True
+        state = next_state
+    return False
 
-    def push_thread(pc: int) -> list[str]:
-        return [
-            f"lea rax, .Lop_{pc}",
-            "push rax",
-            "mov rax, rdi",
-            "push rdi",
-        ]
 
+# The most DFA states match_many builds for one call.
+MAX_DFA_STATES = 10_000
+
+
+def match_many(ops: list[Opcode], texts: Iterable[str]) -> list[bool]:
+    """match(ops, text) for each of texts.
+
+    Walks a DFA that is built lazily, one transition at a time, as the texts
+    reach (state, character) pairs it has not seen before. Once a transition
+    exists, following it costs one dict lookup. Once the DFA has
+    MAX_DFA_STATES states (subset construction can blow up exponentially),
+    texts that need a transition it does not have go through match instead.
+    """
+    tags, arg1, arg2 = compile_to_arrays(_expand_char_runs(ops))
+    start = _start_states(tags, arg1, arg2)
+    if start is None:
+        return [True for _ in texts]
+    stack = [0] * len(tags)
+    # Negative targets mark the end of the walk.
+    dead, accept = -1, -2
+    states = [frozenset(start)]
+    trans: list[dict[int, int]] = [{}]
+    ids = {states[0]: 0}
+    result = []
+    for text in texts:
+        state = 0
+        matched = False
+        for ch in _text_buffer(text):
+            next_state = trans[state].get(ch)
+            if next_state is None:
+                if len(states) >= MAX_DFA_STATES:
+                    matched = match(ops, text)
+                    break
+                key = _dfa_next(tags, arg1, arg2, stack, states[state], ch)
+                if key is None:
+                    next_state = accept
+                elif not key:
+                    next_state = dead
+                elif key in ids:
+                    next_state = ids[key]
+                else:
+                    next_state = ids[key] = len(states)
+                    states.append(key)
+                    trans.append({})
+                trans[state][ch] = next_state
+            if next_state < 0:
+                matched = next_state == accept
+                break
+            state = next_state
+        result.append(matched)
+    return result
+
+
+@_memoize
+def codegen(expr: Expr) -> Callable[[str], bool]:
+    """Generate and exec a Python matcher specialized to expr.
+
+    Instead of interpreting opcodes, the generated function tracks the set
+    of text positions reachable after each subexpression, with the literals
+    baked in as constants. Seq, Alt, Maybe and Lit become straight-line set
+    comprehensions; each Star/Plus body becomes a helper function applied
+    until no new positions turn up. Matchers are cached by expression.
+    """
+    source = _codegen_source(expr)
+    namespace: dict[str, Callable[[str], bool]] = {}
+    exec(source, namespace)
+    return namespace["matcher"]
+
+
+def _codegen_source(expr: Expr) -> str:
+    functions: list[list[str]] = []
+    counter = 0
+    # Names of the position sets computed so far. Each expression applies to
+    # the positions named on top and replaces them with its result.
+    names = ["s0"]
+    body: list[str] = []
+    # As in compile: expressions to emit, each with the lines it goes into,
+    # or steps to run once everything pushed after them has been emitted.
+    work: list[tuple[Expr, list[str]] | Callable[[], None]] = [(expr, body)]
+
+    def fresh() -> str:
+        nonlocal counter
+        counter += 1
+        return f"s{counter}"
+
+    def push(name: str) -> Callable[[], None]:
+        return lambda: names.append(name)
+
+    def union(lines: list[str]) -> Callable[[], None]:
+        "Replace the top two names with their union."
+
+        def step() -> None:
+            right = names.pop()
+            left = names.pop()
+            out = fresh()
+            lines.append(f"{out} = {left} | {right}")
+            names.append(out)
+
+        return step
+
+    def loop(start: str, lines: list[str], body_lines: list[str]) -> Callable[[], None]:
+        "Wrap the loop body emitted into body_lines in a function and iterate it."
+
+        def step() -> None:
+            name = f"_loop{len(functions)}"
+            functions.append(
+                [
+                    f"def {name}(t, n, s0):",
+                    *(f"    {line}" for line in body_lines),
+                    f"    return {names.pop()}",
+                ]
+            )
+            out = fresh()
+            lines.extend(
+                [
+                    f"{out} = set({start})",
+                    f"frontier = {start}",
+                    "while frontier:",
+                    f"    frontier = {name}(t, n, frontier) - {out}",
+                    f"    {out} |= frontier",
+                ]
+            )
+            names.append(out)
+
+        return step
+
+    while work:
+        item = work.pop()
+        if callable(item):
+            item()
+            continue
+        match item:
+            case Lit(value), lines:
+                assert len(value) == 1, "Only single character literals are supported"
+                start, out = names.pop(), fresh()
+                test = f"i < n and t[i] == {value!r}"
+                lines.append(f"{out} = {{i + 1 for i in {start} if {test}}}")
+                names.append(out)
+            case Seq(left, right), lines:
+                work += [(right, lines), (left, lines)]
+            case Alt(left, right), lines:
+                work += [union(lines), (right, lines), push(names[-1]), (left, lines)]
+            case Maybe(body_expr), lines:
+                names.append(names[-1])
+                work += [union(lines), (body_expr, lines)]
+            case Star(body_expr), lines:
+                body_lines: list[str] = []
+                work += [loop(names.pop(), lines, body_lines), (body_expr, body_lines)]
+                names.append("s0")
+            case Plus(body_expr), lines:
+                work += [(Star(body_expr), lines), (body_expr, lines)]
+            case unsupported, _:
+                raise NotImplementedError(f"Unsupported expression: {unsupported}")
+
+    end = names.pop()
+    lines = [line for function in functions for line in function]
+    lines += ["def matcher(t):", "    n = len(t)", "    s0 = {0}"]
+    lines += [f"    {line}" for line in body]
+    lines.append(f"    return bool({end})")
+    return "\n".join(lines) + "\n"
+
+
+# Backtrack points are pushed on the machine stack; give up (and return -1)
+# rather than overflow it.
+MAX_NATIVE_THREADS = 1 << 14
+
+
+def native_compile(ops: list[Opcode]) -> bytes:
+    """Compile ops to x86-64 machine code for `int match(const char *text)`.
+
+    text is a nul-terminated UTF-8 string in rdi, followed by at least 7 more
+    readable bytes so that CharRuns can compare 8 bytes at a time without
+    reading out of bounds. Split pushes a backtrack
+    point (resume address, rdi) on the machine stack and takes its first
+    branch; a failed Char pops the most recent backtrack point and resumes
+    it. The function returns 1 on match, 0 on no match, and -1 if more than
+    MAX_NATIVE_THREADS backtrack points are live.
+
+    Every pc that a Jump or Split branches back to gets a stack slot holding
+    rdi as of the last time it was reached. Taking the back branch again
+    without having moved rdi would only repeat that loop iteration, so the
+    branch fails instead; this is what stops loops whose body can match the
+    empty string from running forever.
+    """
+    nops = len(ops)
+    code = bytearray()
+    labels: dict[int | str, int] = {}
+    fixups: list[tuple[int, int | str]] = []
+    # Loop heads, numbered in the order their slots are pushed.
+    slots: dict[int, int] = {}
+    for pc, op in enumerate(ops):
+        match op:
+            case Jump(target):
+                targets = [pc + 1 + target]
+            case Split(target1, target2):
+                targets = [pc + 1 + target1, pc + 1 + target2]
+            case _:
+                targets = []
+        for target in targets:
+            if target <= pc:
+                slots.setdefault(max(target, 0), len(slots))
+
+    def emit(chunk: bytes) -> None:
+        code.extend(chunk)
+
+    def emit_rel32(label: int | str) -> None:
+        # Every rel32 operand we emit is the last field of its instruction,
+        # so it is relative to the end of these 4 placeholder bytes.
+        fixups.append((len(code), label))
+        code.extend(bytes(4))
+
+    def slot(pc: int) -> bytes:
+        "[rbp + disp32] operand of the slot for loop head pc"
+        return (-8 * (slots[pc] + 1)).to_bytes(4, "little", signed=True)
+
+    def encode(value: str) -> bytes:
+        if value == "\0":
+            raise ValueError("Native code cannot match nul characters")
+        return value.encode()
+
+    def emit_char(value: str) -> None:
+        emit_bytes(encode(value))
+
+    def emit_bytes(data: bytes) -> None:
+        # Strings are nul-terminated; we assume the regex has no nul so we
+        # can check for out-of-bounds and non-matching in one comparison
+        for byte in data:
+            # cmp byte [rdi], imm8; jne .Lno_match; inc rdi
+            emit(b"\x80\x3f" + bytes([byte]) + b"\x0f\x85")
+            emit_rel32("no_match")
+            emit(b"\x48\xff\xc7")
+
+    def emit_check_overflow() -> None:
+        # cmp rsp, r11; jb .Loverflow
+        emit(b"\x4c\x39\xdc\x0f\x82")
+        emit_rel32("overflow")
+
+    def emit_push_thread(label: int | str) -> None:
+        emit_check_overflow()
+        # lea rax, .Lop_N; push rax; push rdi
+        emit(b"\x48\x8d\x05")
+        emit_rel32(label)
+        emit(b"\x50\x57")
+
+    def emit_branch_back(target: int) -> None:
+        # cmp rdi, [slot]; je .Lno_match; jmp .Lop_N
+        emit(b"\x48\x3b\xbd" + slot(target) + b"\x0f\x84")
+        emit_rel32("no_match")
+        emit(b"\xe9")
+        emit_rel32(target)
+
+    # push rbp; mov rbp, rsp; push 0 for each slot
+    emit(b"\x55\x48\x89\xe5" + b"\x6a\x00" * len(slots))
+    # mov r10, rsp; mov r11, rsp; sub r11, imm32
+    emit(b"\x49\x89\xe2\x49\x89\xe3\x49\x81\xeb")
+    emit((16 * MAX_NATIVE_THREADS).to_bytes(4, "little"))
     for pc, op in enumerate(ops):
-        result.append(f".Lop_{pc}")
+        labels[pc] = len(code)
+        if pc in slots:
+            # Push the old value with a backtrack point that puts it back.
+            emit_check_overflow()
+            # lea rax, .Lrestore_N; push rax; push qword [slot]
+            emit(b"\x48\x8d\x05")
+            emit_rel32(f"restore_{pc}")
+            emit(b"\x50\xff\xb5" + slot(pc))
+            # mov [slot], rdi
+            emit(b"\x48\x89\xbd" + slot(pc))
         pc += 1
-        if isinstance(op, Char):
-            result += [
-                # Strings are nul-terminated; we assume the regex has no
-                # nul so we can check for out-of-bounds and non-matching in
-                # one comparison
-                f"cmpb [rdi], 0x{ord(op.value)}",
-                "jne .Lno_match",
-                "inc rdi",
-            ]
-        elif isinstance(op, Match):
-            result.append("jmp .Lmatch")
-        elif isinstance(op, Jump):
-            result.append(f"jmp .Lop_{pc+op.target}")
-        elif isinstance(op, Split):
-            result += [
-                *push_thread(pc + op.target2),
-                f"jmp .Lop_{pc+op.target1}",
-            ]
-        else:
-            raise NotImplementedError(f"Unsupported opcode: {op}")
-    result.append(f".Lop_{pc}")
-    return "\n".join(result)
+        match op:
+            case Char(value):
+                emit_char(value)
+            case CharRun(value, count):
+                run = encode(value) * count
+                # Compare a word at a time. rdi never moves past the nul, so a
+                # word read from it stays within the 7 bytes of padding.
+                while len(run) >= 8:
+                    # mov rax, imm64; cmp [rdi], rax; jne .Lno_match; add rdi, 8
+                    emit(b"\x48\xb8" + run[:8] + b"\x48\x39\x07\x0f\x85")
+                    emit_rel32("no_match")
+                    emit(b"\x48\x83\xc7\x08")
+                    run = run[8:]
+                emit_bytes(run)
+            case CharStar(value):
+                # Greedy: consume as many as possible, then push one backtrack
+                # point that gives them back one at a time (see
+                # .Lback_off_N below) instead of one point per character.
+                data = encode(value)
+                # mov rsi, rdi
+                emit(b"\x48\x89\xfe")
+                labels[f"scan_{pc}"] = len(code)
+                for offset, byte in enumerate(data):
+                    # cmp byte [rdi + offset], imm8; jne .Lscanned_N
+                    if offset:
+                        emit(b"\x80\x7f" + bytes([offset, byte]) + b"\x0f\x85")
+                    else:
+                        emit(b"\x80\x3f" + bytes([byte]) + b"\x0f\x85")
+                    emit_rel32(f"scanned_{pc}")
+                # add rdi, len; jmp .Lscan_N
+                emit(b"\x48\x83\xc7" + bytes([len(data)]) + b"\xe9")
+                emit_rel32(f"scan_{pc}")
+                labels[f"scanned_{pc}"] = len(code)
+                # cmp rdi, rsi; je .Lop_N
+                emit(b"\x48\x39\xf7\x0f\x84")
+                emit_rel32(pc)
+                emit_check_overflow()
+                # push rsi, under a backtrack point at .Lback_off_N
+                emit(b"\x56")
+                emit_push_thread(f"back_off_{pc}")
+            case Match():
+                # jmp .Lmatch
+                emit(b"\xe9")
+                emit_rel32("match")
+            case Jump(target):
+                target = min(pc + target, nops)
+                if target < pc:
+                    emit_branch_back(max(target, 0))
+                else:
+                    # jmp .Lop_N
+                    emit(b"\xe9")
+                    emit_rel32(target)
+            case Split(target1, target2):
+                target1 = min(pc + target1, nops)
+                target2 = min(pc + target2, nops)
+                if target2 < pc:
+                    # Skip the backtrack point if it would repeat the loop.
+                    # cmp rdi, [slot]; je .Lsplit_N
+                    emit(b"\x48\x3b\xbd" + slot(max(target2, 0)) + b"\x0f\x84")
+                    emit_rel32(f"split_{pc}")
+                    emit_push_thread(max(target2, 0))
+                    labels[f"split_{pc}"] = len(code)
+                else:
+                    emit_push_thread(target2)
+                if target1 < pc:
+                    emit_branch_back(max(target1, 0))
+                else:
+                    # jmp .Lop_N
+                    emit(b"\xe9")
+                    emit_rel32(target1)
+            case _:
+                raise NotImplementedError(f"Unsupported opcode: {op}")
+    # Falling off the end of the program is a match.
+    labels[nops] = labels["match"] = len(code)
+    # mov eax, 1; mov rsp, rbp; pop rbp; ret
+    emit(b"\xb8\x01\x00\x00\x00\x48\x89\xec\x5d\xc3")
+    labels["no_match"] = len(code)
+    # cmp rsp, r10; je .Lfail
+    emit(b"\x4c\x39\xd4\x0f\x84")
+    emit_rel32("fail")
+    # pop rdi; pop rax; jmp rax
+    emit(b"\x5f\x58\xff\xe0")
+    labels["fail"] = len(code)
+    # xor eax, eax; mov rsp, rbp; pop rbp; ret
+    emit(b"\x31\xc0\x48\x89\xec\x5d\xc3")
+    labels["overflow"] = len(code)
+    # mov eax, -1; mov rsp, rbp; pop rbp; ret
+    emit(b"\xb8\xff\xff\xff\xff\x48\x89\xec\x5d\xc3")
+    for pc in slots:
+        labels[f"restore_{pc}"] = len(code)
+        # rdi holds the old value: mov [slot], rdi; jmp .Lno_match
+        emit(b"\x48\x89\xbd" + slot(pc) + b"\xe9")
+        emit_rel32("no_match")
+    for pc, op in enumerate(ops, 1):
+        if not isinstance(op, CharStar):
+            continue
+        # Entered with rdi at the end of the characters last tried and the
+        # start of the run on top of the stack.
+        labels[f"back_off_{pc}"] = len(code)
+        # sub rdi, len; cmp rdi, [rsp]; je .Lback_off_last_N
+        emit(b"\x48\x83\xef" + bytes([len(op.value.encode())]))
+        emit(b"\x48\x3b\x3c\x24\x0f\x84")
+        emit_rel32(f"back_off_last_{pc}")
+        # Replaces the backtrack point just popped, so no overflow check.
+        # lea rax, .Lback_off_N; push rax; push rdi; jmp .Lop_N
+        emit(b"\x48\x8d\x05")
+        emit_rel32(f"back_off_{pc}")
+        emit(b"\x50\x57\xe9")
+        emit_rel32(pc)
+        labels[f"back_off_last_{pc}"] = len(code)
+        # Nothing left to give back. add rsp, 8; jmp .Lop_N
+        emit(b"\x48\x83\xc4\x08\xe9")
+        emit_rel32(pc)
+    for offset, label in fixups:
+        code[offset : offset + 4] = (labels[label] - (offset + 4)).to_bytes(
+            4, "little", signed=True
+        )
+    return bytes(code)
+
+
+class NativeMatcher:
+    "Executable copy of native_compile output, callable on a str."
+
+    def __init__(self, code: bytes) -> None:
+        prot = mmap.PROT_READ | mmap.PROT_WRITE | mmap.PROT_EXEC
+        self._buf = mmap.mmap(-1, len(code), prot=prot)
+        self._buf.write(code)
+        addr = ctypes.addressof(ctypes.c_char.from_buffer(self._buf))
+        self._func = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_char_p)(addr)
+
+    def __call__(self, text: str) -> bool:
+        # native_compile may read up to 7 bytes past the nul.
+        result = self._func(text.encode() + bytes(7))
+        if result < 0:
+            raise RuntimeError("Too many threads")
+        return bool(result)
+
+
+def native_match(ops: list[Opcode]) -> NativeMatcher:
+    return NativeMatcher(native_compile(ops))
+
+
+class MemoizeTests(unittest.TestCase):
+    def test_memoize_caches(self) -> None:
+        calls = []
+        double = _memoize(lambda n: calls.append(n) or 2 * n)
+        self.assertEqual([double(1), double(2), double(1)], [2, 4, 2])
+        self.assertEqual(calls, [1, 2])
+
+    def test_memoize_unhashably_deep_argument(self) -> None:
+        calls = []
+        deep = _memoize(lambda expr: calls.append(expr) or len(calls))
+        expr: Expr = Lit("a")
+        for _ in range(5000):
+            expr = Seq(Lit("b"), expr)
+        self.assertEqual(deep(expr), 1)
+        self.assertEqual(deep(expr), 2)
+
+    def test_memoize_runs_function_once_on_recursion_error(self) -> None:
+        calls = []
+
+        def overflow(n: int) -> int:
+            calls.append(n)
+            raise RecursionError
+
+        with self.assertRaises(RecursionError):
+            _memoize(overflow)(1)
+        self.assertEqual(calls, [1])
 
 
 class CompileTests(unittest.TestCase):
+    def test_opcodes_have_no_dict(self) -> None:
+        for op in [Char("a"), CharStar("a"), CharRun("a", 2), Match(), Jump(0)]:
+            self.assertFalse(hasattr(op, "__dict__"), op)
+
+    def test_compile_returns_a_copy(self) -> None:
+        ops = compile(Seq(Lit("a"), Lit("b")))
+        ops.append(Match())
+        self.assertEqual(compile(Seq(Lit("a"), Lit("b"))), [Char("a"), Char("b")])
+
     def test_compile_lit(self) -> None:
         self.assertEqual(compile(Lit("a")), [Char("a")])
 
@@ -190,13 +1117,239 @@ class CompileTests(unittest.TestCase):
             [Char("a"), Char("b"), Char("c")],
         )
 
+    def test_compile_long_seq(self) -> None:
+        expr: Expr = Lit("a")
+        for _ in range(5000):
+            expr = Seq(expr, Lit("a"))
+        self.assertEqual(compile(expr), [CharRun("a", 5001)])
+
+    def test_compile_nested_alt(self) -> None:
+        self.assertEqual(
+            compile(Alt(Alt(Lit("a"), Lit("b")), Lit("c"))),
+            [
+                Split(0, 5),
+                Split(0, 2),
+                Char("a"),
+                Jump(1),
+                Char("b"),
+                Jump(1),
+                Char("c"),
+            ],
+        )
+
+    def test_compile_star(self) -> None:
+        self.assertEqual(
+            compile(Star(Seq(Lit("a"), Lit("b")))),
+            [Split(0, 3), Char("a"), Char("b"), Jump(-4)],
+        )
+
+    def test_compile_star_lit(self) -> None:
+        self.assertEqual(compile(Star(Lit("a"))), [CharStar("a")])
+
+    def test_compile_plus(self) -> None:
+        self.assertEqual(
+            compile(Plus(Seq(Lit("a"), Lit("b")))),
+            [Char("a"), Char("b"), Split(-3, 0)],
+        )
+
+    def test_compile_plus_lit(self) -> None:
+        self.assertEqual(compile(Plus(Lit("a"))), [Char("a"), CharStar("a")])
+
+    def test_compile_maybe(self) -> None:
+        self.assertEqual(
+            compile(Seq(Maybe(Lit("a")), Lit("b"))),
+            [Split(0, 1), Char("a"), Char("b")],
+        )
+
     def test_compile_alt(self) -> None:
         self.assertEqual(
             compile(Alt(Lit("a"), Lit("b"))),
-            [Split(0, 2), Char("a"), Jump(2), Char("b")],
+            [Split(0, 2), Char("a"), Jump(1), Char("b")],
+        )
+
+    def test_compile_alt_seq(self) -> None:
+        self.assertEqual(
+            compile(Seq(Alt(Lit("a"), Lit("b")), Lit("c"))),
+            [Split(0, 2), Char("a"), Jump(1), Char("b"), Char("c")],
         )
 
 
+class CoalesceCharRunsTests(unittest.TestCase):
+    def test_coalesce(self) -> None:
+        self.assertEqual(
+            coalesce_char_runs([Char("a"), Char("a"), Char("a"), Char("b")]),
+            [CharRun("a", 3), Char("b")],
+        )
+
+    def test_relocates_jumps(self) -> None:
+        self.assertEqual(
+            coalesce_char_runs(
+                [Split(0, 3), Char("a"), Char("a"), Jump(2), Char("b"), Char("b")]
+            ),
+            [Split(0, 2), CharRun("a", 2), Jump(1), CharRun("b", 2)],
+        )
+
+    def test_stops_at_jump_target(self) -> None:
+        prog = [Char("a"), Char("a"), Char("a"), Split(-3, 0)]
+        self.assertEqual(
+            coalesce_char_runs(prog),
+            [Char("a"), CharRun("a", 2), Split(-2, 0)],
+        )
+
+    def test_expand_char_runs(self) -> None:
+        prog = [Split(0, 3), Char("a"), Char("a"), Jump(2), Char("b"), Char("b")]
+        self.assertEqual(_expand_char_runs(coalesce_char_runs(prog)), prog)
+
+
+class CompileToArraysTests(unittest.TestCase):
+    def test_char_is_code_point(self) -> None:
+        tags, arg1, arg2 = compile_to_arrays([Char("a"), Match()])
+        self.assertEqual(list(tags), [CHAR, MATCH, MATCH])
+        self.assertEqual(list(arg1), [ord("a"), 0, 0])
+        self.assertEqual(list(arg2), [1, 0, 0])
+
+    def test_char_star_continues_at_itself(self) -> None:
+        tags, arg1, arg2 = compile_to_arrays([CharStar("a")])
+        self.assertEqual(list(tags), [CHAR_STAR, MATCH])
+        self.assertEqual(list(arg1), [ord("a"), 0])
+        self.assertEqual(list(arg2), [0, 0])
+
+    def test_targets_are_absolute(self) -> None:
+        tags, arg1, arg2 = compile_to_arrays(
+            [Split(0, 2), Char("a"), Jump(1), Char("b")]
+        )
+        self.assertEqual(list(tags), [SPLIT, CHAR, JUMP, CHAR, MATCH])
+        self.assertEqual(list(arg1), [1, ord("a"), 4, ord("b"), 0])
+        self.assertEqual(list(arg2), [3, 2, 0, 4, 0])
+
+    def test_targets_are_clamped(self) -> None:
+        tags, arg1, arg2 = compile_to_arrays([Split(-5, 3), Jump(-3), Jump(9)])
+        self.assertEqual(list(arg1), [0, 0, 3, 0])
+        self.assertEqual(list(arg2), [3, 0, 0, 0])
+
+    def test_unknown_opcode(self) -> None:
+        with self.assertRaises(NotImplementedError):
+            compile_to_arrays([Opcode()])
+
+
+@unittest.skipIf(match_c is None, "rsc_regex_vm is not built")
+class MatchCTests(unittest.TestCase):
+    def test_agrees_with_match_arrays(self) -> None:
+        progs = [
+            [],
+            [Match(), Char("x")],
+            [Char("a"), Jump(1), Char("x"), Char("b")],
+            [Split(0, 2), Char("a"), Jump(2), Char("b"), Char("c")],
+            compile(Alt(Seq(Lit("a"), Lit("b")), Seq(Lit("c"), Lit("é")))),
+            compile(Seq(Star(Alt(Lit("a"), Lit("b"))), Lit("c"))),
+            compile(Seq(Plus(Lit("a")), Maybe(Lit("b")))),
+            compile(Seq(Star(Alt(Seq(Lit("a"), Lit("a")), Lit("b"))), Lit("c"))),
+        ]
+        texts = ["", "a", "ab", "ax", "bc", "c", "cé", "ce", "abac", "aabaac", "aac"]
+        for prog in progs:
+            arrays = compile_to_arrays(prog)
+            for text in texts:
+                self.assertEqual(
+                    match_c(*arrays, text.encode("latin-1")),
+                    _match_arrays(*arrays, text),
+                    (prog, text),
+                )
+                self.assertEqual(
+                    match_c(*arrays, b"x" + text.encode("latin-1"), 1),
+                    _match_arrays(*arrays, text),
+                    (prog, text),
+                )
+
+    def test_huge_char_run(self) -> None:
+        # The resume ring is sized by the text, not the run.
+        prog = [Split(0, 2), CharRun("a", 3_000_000), Jump(1), Char("b"), Char("c")]
+        arrays = compile_to_arrays(prog)
+        self.assertFalse(match_c(*arrays, b"b"))
+        self.assertTrue(match_c(*arrays, b"bc"))
+        self.assertTrue(match_c(*arrays, b"a" * 3_000_000 + b"c"))
+        self.assertFalse(match_c(*arrays, b"a" * 2_999_999 + b"c"))
+
+    def test_overlapping_char_runs(self) -> None:
+        runs = [Seq(Seq(Lit("a"), Lit("a")), Lit(c)) for c in "bcd"]
+        expr = Seq(Star(Lit("x")), Alt(Alt(runs[0], Seq(Lit("a"), runs[1])), runs[2]))
+        prog = compile(expr)
+        self.assertTrue(any(isinstance(op, CharRun) for op in prog))
+        arrays = compile_to_arrays(prog)
+        for text in ["aab", "aaac", "aad", "xaac", "xaaad", "aa", "a", "xaaab"]:
+            self.assertEqual(
+                match_c(*arrays, text.encode("latin-1")),
+                _match_arrays(*arrays, text),
+                text,
+            )
+
+    def test_target_before_start(self) -> None:
+        for prog in [[Jump(-2), Char("a")], [Char("a"), Jump(-5), Char("b")]]:
+            arrays = compile_to_arrays(prog)
+            for text in ["", "x", "a", "ab", "aab"]:
+                self.assertEqual(
+                    match_c(*arrays, text.encode("latin-1")),
+                    _match_arrays(*arrays, text),
+                    (prog, text),
+                )
+            self.assertFalse(match(prog, "ab"))
+
+    def test_rejects_out_of_range_pcs(self) -> None:
+        tags, arg1, arg2 = compile_to_arrays([Char("a"), Jump(0)])
+        arg1[1] = -1
+        with self.assertRaises(ValueError):
+            match_c(tags, arg1, arg2, b"ab")
+        arg1[1] = len(tags)
+        with self.assertRaises(ValueError):
+            match_c(tags, arg1, arg2, b"ab")
+        with self.assertRaises(ValueError):
+            match_c(tags[:-1], arg1[:-1], arg2[:-1], b"ab")
+
+    def test_long_char_runs(self) -> None:
+        for count in range(2, 20):
+            arrays = compile_to_arrays([CharRun("a", count), Char("b")])
+            for n in range(count - 1, count + 2):
+                for tail in ["b", "xb", ""]:
+                    text = "a" * n + tail
+                    self.assertEqual(
+                        match_c(*arrays, text.encode("latin-1")),
+                        _match_arrays(*arrays, text),
+                        (count, text),
+                    )
+
+
+class MatchArraysTests(unittest.TestCase):
+    def test_start(self) -> None:
+        arrays = compile_to_arrays(compile(Seq(Lit("a"), Lit("b"))))
+        self.assertTrue(_match_arrays(*arrays, "xxab", 2))
+        self.assertFalse(_match_arrays(*arrays, "xxab", 1))
+
+    def test_start_char_run(self) -> None:
+        arrays = compile_to_arrays([CharRun("a", 3)])
+        self.assertTrue(_match_arrays(*arrays, "baaa", 1))
+        self.assertFalse(_match_arrays(*arrays, "baab", 1))
+        self.assertFalse(_match_arrays(*arrays, "baa", 1))
+
+
+class ExtractPrefixTests(unittest.TestCase):
+    def test_leading_chars(self) -> None:
+        self.assertEqual(
+            _extract_prefix([Char("a"), Char("b"), Split(0, 1), Char("c")]),
+            ("ab", [Split(0, 1), Char("c")]),
+        )
+
+    def test_all_chars(self) -> None:
+        self.assertEqual(_extract_prefix([Char("a"), Char("b")]), ("ab", []))
+
+    def test_stops_at_jump_target(self) -> None:
+        # The Split loops back to the second Char.
+        prog = [Char("a"), Char("b"), Split(-2, 0)]
+        self.assertEqual(_extract_prefix(prog), ("a", prog[1:]))
+
+    def test_no_prefix(self) -> None:
+        prog = [Split(0, 2), Char("a"), Jump(1), Char("b")]
+        self.assertEqual(_extract_prefix(prog), ("", prog))
+
+
 class MatchTests(unittest.TestCase):
     def test_match_char_matches(self) -> None:
         self.assertTrue(match([Char("a")], "a"))
@@ -205,6 +1358,24 @@ class MatchTests(unittest.TestCase):
     def test_match_char_does_not_match(self) -> None:
         self.assertFalse(match([Char("a")], "b"))
 
+    def test_target_before_start_agrees_across_backends(self) -> None:
+        # The Jumps land before pc 0, which every backend clamps to pc 0, so
+        # neither program can get past its first loop.
+        for prog in [[Jump(-2), Char("a")], [Char("a"), Jump(-5), Char("b")]]:
+            for text in ["", "x", "a", "ab", "aab"]:
+                self.assertFalse(match(prog, text), (prog, text))
+                self.assertFalse(match_dfa(to_dfa(prog), text), (prog, text))
+                self.assertEqual(match_many(prog, [text]), [False], (prog, text))
+
+    def test_match_program_modified_in_place(self) -> None:
+        ops: list[Opcode] = [Char("a")]
+        self.assertTrue(match(ops, "a"))
+        ops[0] = Char("b")
+        self.assertFalse(match(ops, "a"))
+        ops.append(Char("c"))
+        self.assertTrue(match(ops, "bc"))
+        self.assertFalse(match(ops, "b"))
+
     def test_match_chars_matches(self) -> None:
         self.assertTrue(match([Char("a"), Char("b")], "ab"))
         self.assertTrue(match([Char("a"), Char("b")], "abc"))
@@ -229,6 +1400,41 @@ class MatchTests(unittest.TestCase):
         self.assertFalse(match(prog, "c"))
         self.assertTrue(match(prog, "bc"))
 
+    def test_match_non_latin1_text(self) -> None:
+        self.assertTrue(match([Char("€"), Char("a")], "€a"))
+        self.assertFalse(match([Char("a")], "€"))
+
+    def test_match_after_prefix(self) -> None:
+        prog = [Char("a"), Char("b"), Split(-2, 0), Char("c")]
+        self.assertTrue(match(prog, "abc"))
+        self.assertTrue(match(prog, "abbbc"))
+        self.assertFalse(match(prog, "abac"))
+        self.assertFalse(match(prog, "ac"))
+
+    def test_match_many_alternatives(self) -> None:
+        expr: Expr = Lit("a")
+        for c in "bcdefghijklmnopqrstuvwxyz":
+            expr = Alt(expr, Lit(c))
+        prog = compile(expr)
+        self.assertTrue(match(prog, "a"))
+        self.assertTrue(match(prog, "z"))
+        self.assertFalse(match(prog, "0"))
+
+    def test_match_deeply_nested_alt(self) -> None:
+        expr: Expr = Lit("a")
+        for _ in range(5000):
+            expr = Alt(Lit("b"), expr)
+        self.assertTrue(match(compile(expr), "a"))
+
+    def test_match_does_not_blow_up(self) -> None:
+        # (a|a)(a|a)...b backtracks 2**n ways before failing.
+        expr: Expr = Alt(Lit("a"), Lit("a"))
+        for _ in range(30):
+            expr = Seq(expr, Alt(Lit("a"), Lit("a")))
+        prog = compile(Seq(expr, Lit("b")))
+        self.assertFalse(match(prog, "a" * 31))
+        self.assertTrue(match(prog, "a" * 31 + "b"))
+
 
 class EndToEndTests(unittest.TestCase):
     def test_match_lit(self) -> None:
@@ -255,97 +1461,326 @@ class EndToEndTests(unittest.TestCase):
         self.assertTrue(match(ab_or_cd, "ab"))
         self.assertTrue(match(ab_or_cd, "cd"))
 
+    def test_match_star(self) -> None:
+        prog = compile(Seq(Star(Seq(Lit("a"), Lit("b"))), Lit("c")))
+        self.assertTrue(match(prog, "c"))
+        self.assertTrue(match(prog, "ababc"))
+        self.assertFalse(match(prog, "abac"))
+        self.assertFalse(match(prog, "aba"))
+
+    def test_match_star_lit(self) -> None:
+        prog = compile(Seq(Star(Lit("a")), Lit("b")))
+        self.assertTrue(match(prog, "b"))
+        self.assertTrue(match(prog, "aaab"))
+        self.assertFalse(match(prog, "aaa"))
+        self.assertFalse(match(prog, "aac"))
+
+    def test_match_plus(self) -> None:
+        prog = compile(Seq(Plus(Alt(Lit("a"), Lit("b"))), Lit("c")))
+        self.assertTrue(match(prog, "ac"))
+        self.assertTrue(match(prog, "abbac"))
+        self.assertFalse(match(prog, "c"))
+        self.assertFalse(match(prog, "abx"))
 
-class NativeCompileTests(unittest.TestCase):
-    def test_native_compile_lit(self) -> None:
-        self.assertEqual(
-            native_compile([Char("a")]),
-            "\n".join(
-                [
-                    ".Lop_0",
-                    "cmpb [rdi], 0x97",
-                    "jne .Lno_match",
-                    "inc rdi",
-                    ".Lop_1",
-                ]
-            ),
-        )
+    def test_match_plus_lit(self) -> None:
+        prog = compile(Seq(Plus(Lit("a")), Lit("b")))
+        self.assertTrue(match(prog, "ab"))
+        self.assertTrue(match(prog, "aaab"))
+        self.assertFalse(match(prog, "b"))
 
-    def test_native_compile_seq(self) -> None:
+    def test_match_maybe(self) -> None:
+        prog = compile(Seq(Maybe(Lit("a")), Lit("b")))
+        self.assertTrue(match(prog, "b"))
+        self.assertTrue(match(prog, "ab"))
+        self.assertFalse(match(prog, "aab"))
+
+    def test_match_char_run(self) -> None:
+        prog = compile(Seq(Alt(Lit("x"), Seq(Lit("a"), Lit("a"))), Lit("b")))
+        self.assertIn(CharRun("a", 2), prog)
+        self.assertTrue(match(prog, "xb"))
+        self.assertTrue(match(prog, "aab"))
+        self.assertFalse(match(prog, "ab"))
+        self.assertFalse(match(prog, "aa"))
+        self.assertFalse(match(prog, "aaab"))
+
+    def test_match_char_run_in_loop(self) -> None:
+        # (aaa|b)*c
+        aaa = Seq(Seq(Lit("a"), Lit("a")), Lit("a"))
+        prog = compile(Seq(Star(Alt(aaa, Lit("b"))), Lit("c")))
+        self.assertTrue(match(prog, "c"))
+        self.assertTrue(match(prog, "aaabaaac"))
+        self.assertTrue(match(prog, "bbaaac"))
+        self.assertFalse(match(prog, "aac"))
+        self.assertFalse(match(prog, "aaaac"))
+
+    def test_target_before_start(self) -> None:
+        for prog in [[Jump(-2), Char("a")], [Char("a"), Jump(-5), Char("b")]]:
+            m = native_match(prog)
+            for text in ["", "x", "a", "ab", "aab"]:
+                self.assertEqual(m(text), match(prog, text), (prog, text))
+
+    def test_match_empty_loop(self) -> None:
+        prog = compile(Seq(Star(Maybe(Lit("a"))), Lit("b")))
+        self.assertTrue(match(prog, "aab"))
+        self.assertFalse(match(prog, "aac"))
+
+    def test_match_alt_then_seq(self) -> None:
+        a_or_b_then_c = compile(Seq(Alt(Lit("a"), Lit("b")), Lit("c")))
+        self.assertTrue(match(a_or_b_then_c, "ac"))
+        self.assertTrue(match(a_or_b_then_c, "bc"))
+        self.assertFalse(match(a_or_b_then_c, "a"))
+        self.assertFalse(match(a_or_b_then_c, "b"))
+
+
+class DFATests(unittest.TestCase):
+    def test_to_dfa_alt(self) -> None:
         self.assertEqual(
-            native_compile([Char("a"), Char("b")]),
-            "\n".join(
-                [
-                    ".Lop_0",
-                    "cmpb [rdi], 0x97",
-                    "jne .Lno_match",
-                    "inc rdi",
-                    ".Lop_1",
-                    "cmpb [rdi], 0x98",
-                    "jne .Lno_match",
-                    "inc rdi",
-                    ".Lop_2",
-                ]
-            ),
+            to_dfa(compile(Alt(Lit("a"), Lit("b")))),
+            ([{ord("a"): 1, ord("b"): 1}, {}], [False, True]),
         )
 
-    def test_native_compile_jump(self) -> None:
+    def test_to_dfa_is_cached(self) -> None:
+        prog = compile(Alt(Lit("a"), Lit("b")))
+        self.assertIs(to_dfa(prog), to_dfa(list(prog)))
+
+    def test_to_dfa_empty(self) -> None:
+        self.assertEqual(to_dfa([]), ([{}], [True]))
+
+    def test_match_dfa(self) -> None:
+        ab_or_cd = to_dfa(
+            compile(Alt(Seq(Lit("a"), Lit("b")), Seq(Lit("c"), Lit("d"))))
+        )
+        self.assertFalse(match_dfa(ab_or_cd, ""))
+        self.assertFalse(match_dfa(ab_or_cd, "a"))
+        self.assertFalse(match_dfa(ab_or_cd, "ac"))
+        self.assertFalse(match_dfa(ab_or_cd, "bd"))
+        self.assertTrue(match_dfa(ab_or_cd, "ab"))
+        self.assertTrue(match_dfa(ab_or_cd, "cdx"))
+
+    def test_match_many(self) -> None:
+        prog = compile(Seq(Plus(Lit("a")), Lit("b")))
+        texts = ["ab", "", "aab", "b", "ab", "aaa", "aabx"]
         self.assertEqual(
-            native_compile([Char("a"), Jump(1), Char("b")]),
-            "\n".join(
-                [
-                    ".Lop_0",
-                    "cmpb [rdi], 0x97",
-                    "jne .Lno_match",
-                    "inc rdi",
-                    ".Lop_1",
-                    "jmp .Lop_3",
-                    ".Lop_2",
-                    "cmpb [rdi], 0x98",
-                    "jne .Lno_match",
-                    "inc rdi",
-                    ".Lop_3",
-                ]
-            ),
+            match_many(prog, texts), [True, False, True, False, True, False, True]
         )
+        self.assertEqual(match_many(prog, iter(texts)), match_many(prog, texts))
+
+    def test_match_many_past_state_limit(self) -> None:
+        global MAX_DFA_STATES
+        # (a|b)*a(a|b)(a|b)c: the DFA tracks the last three characters.
+        ab = Alt(Lit("a"), Lit("b"))
+        prog = compile(Seq(Seq(Seq(Seq(Star(ab), Lit("a")), ab), ab), Lit("c")))
+        texts = [f"{i:05b}c".replace("0", "a").replace("1", "b") for i in range(32)]
+        expected = [match(prog, text) for text in texts]
+        self.assertIn(True, expected)
+        limit = MAX_DFA_STATES
+        MAX_DFA_STATES = 4
+        try:
+            self.assertEqual(match_many(prog, texts), expected)
+        finally:
+            MAX_DFA_STATES = limit
+
+    def test_match_dfa_agrees_with_match(self) -> None:
+        progs = [
+            [Split(0, 2), Char("a"), Jump(2), Char("b"), Char("c")],
+            compile(Seq(Star(Alt(Lit("a"), Lit("b"))), Lit("c"))),
+            compile(Seq(Plus(Lit("a")), Maybe(Lit("b")))),
+            compile(Seq(Star(Maybe(Lit("a"))), Lit("b"))),
+            compile(Seq(Star(Alt(Seq(Lit("a"), Lit("a")), Lit("b"))), Lit("c"))),
+        ]
+        for prog in progs:
+            dfa = to_dfa(prog)
+            for text in ["", "a", "b", "c", "bc", "ab", "aab", "abac", "€"]:
+                self.assertEqual(match_dfa(dfa, text), match(prog, text), text)
 
-    def test_native_compile_match(self) -> None:
+
+class CodegenTests(unittest.TestCase):
+    def test_codegen_source_seq(self) -> None:
         self.assertEqual(
-            native_compile([Match()]),
+            _codegen_source(Seq(Lit("a"), Lit("b"))),
             "\n".join(
                 [
-                    ".Lop_0",
-                    "jmp .Lmatch",
-                    ".Lop_1",
+                    "def matcher(t):",
+                    "    n = len(t)",
+                    "    s0 = {0}",
+                    "    s1 = {i + 1 for i in s0 if i < n and t[i] == 'a'}",
+                    "    s2 = {i + 1 for i in s1 if i < n and t[i] == 'b'}",
+                    "    return bool(s2)",
+                    "",
                 ]
             ),
         )
 
-    def test_native_compile_split(self) -> None:
-        self.assertEqual(
-            native_compile([Split(0, 2), Char("a"), Jump(1), Char("b")]),
-            "\n".join(
-                [
-                    ".Lop_0",
-                    "lea rax, .Lop_3",
-                    "push rax",
-                    "mov rax, rdi",
-                    "push rdi",
-                    "jmp .Lop_1",
-                    ".Lop_1",
-                    "cmpb [rdi], 0x97",
-                    "jne .Lno_match",
-                    "inc rdi",
-                    ".Lop_2",
-                    "jmp .Lop_4",
-                    ".Lop_3",
-                    "cmpb [rdi], 0x98",
-                    "jne .Lno_match",
-                    "inc rdi",
-                    ".Lop_4",
-                ]
-            ),
+    def test_codegen_deeply_nested_alt(self) -> None:
+        # Deep enough to overflow the stack if emitted recursively, shallow
+        # enough to exec quickly.
+        expr: Expr = Lit("a")
+        for _ in range(1000):
+            expr = Alt(Lit("b"), expr)
+        m = codegen(expr)
+        self.assertTrue(m("a"))
+        self.assertTrue(m("b"))
+        self.assertFalse(m("c"))
+
+    def test_codegen_is_cached(self) -> None:
+        self.assertIs(codegen(Star(Lit("a"))), codegen(Star(Lit("a"))))
+
+    def test_match_alt_seq(self) -> None:
+        m = codegen(Alt(Seq(Lit("a"), Lit("b")), Seq(Lit("c"), Lit("d"))))
+        self.assertFalse(m(""))
+        self.assertFalse(m("a"))
+        self.assertFalse(m("ac"))
+        self.assertTrue(m("ab"))
+        self.assertTrue(m("cdx"))
+
+    def test_agrees_with_match(self) -> None:
+        exprs = [
+            Seq(Star(Alt(Lit("a"), Lit("b"))), Lit("c")),
+            Seq(Plus(Seq(Lit("a"), Maybe(Lit("b")))), Lit("c")),
+            Seq(Star(Maybe(Lit("a"))), Lit("b")),
+            Seq(Star(Plus(Star(Lit("a")))), Lit("'")),
+        ]
+        for expr in exprs:
+            m = codegen(expr)
+            prog = compile(expr)
+            for text in ["", "a", "c", "abc", "aac", "abac", "abbc", "ab", "a'"]:
+                self.assertEqual(m(text), match(prog, text), (expr, text))
+
+
+class NativeCompileTests(unittest.TestCase):
+    def test_native_compile_lit(self) -> None:
+        code = native_compile([Char("a")])
+        # cmp byte [rdi], 0x61; jne .Lno_match; inc rdi
+        self.assertEqual(code[17:20], b"\x80\x3f\x61")
+        self.assertEqual(code[20:22], b"\x0f\x85")
+        self.assertEqual(code[26:29], b"\x48\xff\xc7")
+
+    def test_native_compile_non_ascii_lit(self) -> None:
+        code = native_compile([Char("é")])
+        self.assertEqual(code[17:20], b"\x80\x3f\xc3")
+        self.assertEqual(code[29:32], b"\x80\x3f\xa9")
+
+    def test_native_compile_char_run(self) -> None:
+        code = native_compile([CharRun("a", 10)])
+        # mov rax, imm64; cmp [rdi], rax
+        self.assertEqual(code[17:30], b"\x48\xb8" + b"a" * 8 + b"\x48\x39\x07")
+        # two more single-byte compares after the word
+        self.assertEqual(code.count(b"\x80\x3f\x61"), 2)
+
+    def test_native_compile_loop_slots(self) -> None:
+        # One zeroed slot per loop head: push rbp; mov rbp, rsp; push 0
+        code = native_compile(compile(Star(Alt(Lit("a"), Lit("b")))))
+        self.assertEqual(code[:8], b"\x55\x48\x89\xe5\x6a\x00\x49\x89")
+        self.assertEqual(native_compile([Char("a")])[:6], b"\x55\x48\x89\xe5\x49\x89")
+
+    def test_native_compile_rejects_nul(self) -> None:
+        with self.assertRaises(ValueError):
+            native_compile([Char("\0")])
+
+
+@unittest.skipUnless(
+    sys.platform == "linux" and platform.machine() == "x86_64",
+    "native code is x86-64 System V only",
+)
+class NativeMatchTests(unittest.TestCase):
+    def test_match_lit(self) -> None:
+        m = native_match(compile(Lit("a")))
+        self.assertTrue(m("a"))
+        self.assertFalse(m("b"))
+        self.assertFalse(m(""))
+
+    def test_match_empty(self) -> None:
+        self.assertTrue(native_match([])(""))
+
+    def test_match_returns_true(self) -> None:
+        self.assertTrue(native_match([Match(), Char("x")])("ac"))
+
+    def test_jump_is_relative_displacement(self) -> None:
+        m = native_match([Char("a"), Jump(1), Char("x"), Char("b")])
+        self.assertTrue(m("ab"))
+        self.assertFalse(m("ax"))
+
+    def test_split_is_relative_displacements(self) -> None:
+        prog = [Split(0, 2), Char("a"), Jump(2), Char("b"), Char("c")]
+        m = native_match(prog)
+        for text in ["", "a", "b", "c", "bc", "ab", "é"]:
+            self.assertEqual(m(text), match(prog, text), text)
+
+    def test_match_alt_seq(self) -> None:
+        m = native_match(
+            compile(Alt(Seq(Lit("a"), Lit("b")), Seq(Lit("c"), Lit("é"))))
         )
+        self.assertFalse(m("a"))
+        self.assertFalse(m("ac"))
+        self.assertTrue(m("ab"))
+        self.assertTrue(m("cé"))
+        self.assertFalse(m("ce"))
+
+    def test_match_star_plus_maybe(self) -> None:
+        progs = [
+            compile(Seq(Star(Alt(Lit("a"), Lit("b"))), Lit("c"))),
+            compile(Seq(Plus(Lit("a")), Seq(Maybe(Lit("b")), Lit("c")))),
+            compile(Seq(Star(Lit("é")), Lit("b"))),
+            compile(Seq(Star(Alt(Seq(Lit("a"), Lit("a")), Lit("b"))), Lit("c"))),
+        ]
+        for prog in progs:
+            m = native_match(prog)
+            for text in ["", "c", "abc", "aac", "abac", "ac", "éb", "ééb", "éc"]:
+                self.assertEqual(m(text), match(prog, text), text)
+
+    def test_match_char_run(self) -> None:
+        for count in [2, 7, 8, 9, 16, 17]:
+            m = native_match([CharRun("a", count), Char("b")])
+            self.assertTrue(m("a" * count + "b"), count)
+            self.assertFalse(m("a" * (count - 1) + "b"), count)
+            self.assertFalse(m("a" * (count - 1)), count)
+            self.assertFalse(m("a" * count), count)
+            self.assertFalse(m("a" * (count - 1) + "xb"), count)
+        m = native_match([CharRun("é", 5)])
+        self.assertTrue(m("ééééé"))
+        self.assertFalse(m("éééé"))
+        self.assertFalse(m("ééééè"))
+
+    def test_match_nullable_loop_bodies(self) -> None:
+        exprs = [
+            Plus(Maybe(Lit("a"))),
+            Star(Maybe(Lit("a"))),
+            Star(Star(Lit("a"))),
+            Seq(Star(Maybe(Lit("a"))), Lit("b")),
+            Seq(Plus(Star(Lit("a"))), Lit("b")),
+            Seq(Star(Alt(Star(Lit("a")), Lit("b"))), Lit("c")),
+        ]
+        for expr in exprs:
+            prog = compile(expr)
+            m = native_match(prog)
+            for text in ["", "a", "b", "c", "aab", "abac", "bbc", "x"]:
+                self.assertEqual(m(text), match(prog, text), (expr, text))
+
+    def test_target_before_start(self) -> None:
+        for prog in [[Jump(-2), Char("a")], [Char("a"), Jump(-5), Char("b")]]:
+            m = native_match(prog)
+            for text in ["", "x", "a", "ab", "aab"]:
+                self.assertEqual(m(text), match(prog, text), (prog, text))
+
+    def test_match_empty_loop(self) -> None:
+        self.assertFalse(native_match([Split(0, 0), Jump(-2), Char("a")])(""))
+        self.assertTrue(native_match([Split(0, 1), Jump(-2)])(""))
+
+    def test_match_long_char_star(self) -> None:
+        n = 4 * MAX_NATIVE_THREADS
+        m = native_match(compile(Seq(Star(Lit("a")), Lit("b"))))
+        self.assertTrue(m("a" * n + "b"))
+        self.assertFalse(m("a" * n))
+        m = native_match(compile(Seq(Star(Lit("é")), Seq(Lit("é"), Lit("b")))))
+        self.assertTrue(m("é" * n + "b"))
+        self.assertFalse(m("é" * n))
+        self.assertFalse(m("b"))
+
+    def test_too_many_threads(self) -> None:
+        # Each iteration of a general loop pushes a backtrack point.
+        prog = compile(Seq(Star(Alt(Lit("a"), Lit("b"))), Lit("c")))
+        with self.assertRaises(RuntimeError):
+            native_match(prog)("ab" * MAX_NATIVE_THREADS)
 
 
 if __name__ == "__main__":
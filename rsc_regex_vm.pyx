@@ -0,0 +1,228 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# distutils: extra_compile_args = -O3
+"""C build of the NFA simulation in rsc_regex.match.
+
+Build in place with `cythonize -i rsc_regex_vm.pyx`. rsc_regex uses match_c
+when this module is importable and falls back to the pure-Python VM
+otherwise.
+"""
+
+from libc.stdlib cimport calloc, free, malloc
+from libc.stdint cimport uint64_t
+from libc.string cimport memcpy, memset
+
+# Must agree with the tags in rsc_regex.
+cdef enum:
+    CHAR = 0
+    MATCH = 1
+    JUMP = 2
+    SPLIT = 3
+    CHAR_STAR = 4
+    CHAR_RUN = 5
+
+
+cdef inline bint addstate(
+    const signed char *tags,
+    const int *arg1,
+    const int *arg2,
+    int *states,
+    int *nstates,
+    unsigned char *on,
+    int *stack,
+    int pc,
+) noexcept nogil:
+    "See rsc_regex._addstate."
+    cdef int sp, tag, target
+    if on[pc]:
+        return False
+    on[pc] = 1
+    stack[0] = pc
+    sp = 1
+    while sp:
+        sp -= 1
+        pc = stack[sp]
+        tag = tags[pc]
+        # Same order as rsc_regex._addstate.
+        if tag == CHAR:
+            states[nstates[0]] = pc
+            nstates[0] += 1
+        elif tag == SPLIT:
+            target = arg2[pc]
+            if not on[target]:
+                on[target] = 1
+                stack[sp] = target
+                sp += 1
+            target = arg1[pc]
+            if not on[target]:
+                on[target] = 1
+                stack[sp] = target
+                sp += 1
+        elif tag == JUMP:
+            target = arg1[pc]
+            if not on[target]:
+                on[target] = 1
+                stack[sp] = target
+                sp += 1
+        elif tag == CHAR_STAR:
+            states[nstates[0]] = pc
+            nstates[0] += 1
+            target = pc + 1
+            if not on[target]:
+                on[target] = 1
+                stack[sp] = target
+                sp += 1
+        elif tag == CHAR_RUN:
+            states[nstates[0]] = pc
+            nstates[0] += 1
+        else:
+            return True
+    return False
+
+
+cdef inline Py_ssize_t find_mismatch(
+    const unsigned char *text, Py_ssize_t start, Py_ssize_t end, unsigned char ch
+) noexcept nogil:
+    """Return the first i in [start, end) with text[i] != ch, or end.
+
+    Compares eight bytes per step: XOR-ing a word of text with ch repeated in
+    every byte leaves zero exactly when all eight bytes match.
+    """
+    cdef uint64_t pattern = 0x0101010101010101ULL * ch
+    cdef uint64_t word
+    cdef Py_ssize_t i = start
+    while end - i >= 8:
+        memcpy(&word, text + i, 8)
+        if word ^ pattern:
+            # The mismatch is somewhere in these eight bytes; the byte loop
+            # below finds it without depending on byte order.
+            break
+        i += 8
+    while i < end:
+        if text[i] != ch:
+            return i
+        i += 1
+    return end
+
+
+cpdef bint match_c(
+    const signed char[::1] tags,
+    const int[::1] arg1,
+    const int[::1] arg2,
+    const unsigned char[::1] text,
+    Py_ssize_t start=0,
+):
+    """Run the output of rsc_regex.compile_to_arrays over latin-1 text[start:].
+
+    Same semantics as rsc_regex.match; tags must end in the MATCH sentinel.
+    Raises ValueError for arrays that compile_to_arrays could not have
+    produced, since the loop below does no bounds checks.
+    """
+    cdef Py_ssize_t size = tags.shape[0]
+    cdef Py_ssize_t ntext = text.shape[0]
+    cdef Py_ssize_t i, j, count, slot
+    cdef int pc, next_pc, nclist, nnlist, tag
+    cdef bint valid
+    cdef unsigned char ch
+    cdef int *clist
+    cdef int *nlist
+    cdef int *tmp
+    cdef bint result = False
+    # Threads that get through a CharRun resume count characters ahead, so
+    # keep a ring of resume lists indexed by text position mod nslots. Each
+    # CharRun pc resumes at a given position at most once, so nruns entries
+    # per slot is enough, and no resume lands past the end of the text, so
+    # the ring never needs more slots than there are characters left.
+    cdef Py_ssize_t max_count = 0
+    cdef Py_ssize_t nslots
+    cdef Py_ssize_t nruns = 0
+    cdef Py_ssize_t npending = 0
+    if size == 0 or tags[size - 1] != MATCH:
+        raise ValueError("tags must end in MATCH")
+    if arg1.shape[0] != size or arg2.shape[0] != size:
+        raise ValueError("tags, arg1 and arg2 must have the same length")
+    for j in range(size):
+        tag = tags[j]
+        if tag == CHAR or tag == CHAR_STAR:
+            valid = 0 <= arg2[j] < size
+        elif tag == JUMP:
+            valid = 0 <= arg1[j] < size
+        elif tag == SPLIT:
+            valid = 0 <= arg1[j] < size and 0 <= arg2[j] < size
+        elif tag == CHAR_RUN:
+            valid = arg2[j] < 0
+            nruns += 1
+            if -arg2[j] > max_count:
+                max_count = -arg2[j]
+        else:
+            valid = tag == MATCH
+        if not valid:
+            raise ValueError(f"Invalid opcode at pc {j}")
+    nslots = min(max_count, max(ntext - start, 0)) + 1
+    cdef int *scratch = <int *>malloc((3 * size + nslots * nruns) * sizeof(int))
+    cdef int *ring_len = <int *>calloc(nslots, sizeof(int))
+    cdef unsigned char *on = <unsigned char *>malloc(size)
+    if scratch == NULL or ring_len == NULL or on == NULL:
+        free(scratch)
+        free(ring_len)
+        free(on)
+        raise MemoryError()
+    clist = scratch
+    nlist = scratch + size
+    cdef int *stack = scratch + 2 * size
+    cdef int *ring = scratch + 3 * size
+    # tags always holds at least the MATCH sentinel.
+    cdef const signed char *ptags = &tags[0]
+    cdef const int *parg1 = &arg1[0]
+    cdef const int *parg2 = &arg2[0]
+    with nogil:
+        memset(on, 0, size)
+        nclist = 0
+        if addstate(ptags, parg1, parg2, clist, &nclist, on, stack, 0):
+            result = True
+        else:
+            for i in range(start, ntext):
+                ch = text[i]
+                memset(on, 0, size)
+                nnlist = 0
+                for j in range(nclist):
+                    pc = clist[j]
+                    if parg1[pc] != ch:
+                        continue
+                    next_pc = parg2[pc]
+                    if next_pc >= 0:
+                        if addstate(
+                            ptags, parg1, parg2, nlist, &nnlist, on, stack, next_pc
+                        ):
+                            result = True
+                            break
+                    else:
+                        count = -next_pc
+                        if count <= ntext - i and find_mismatch(
+                            &text[0], i, i + count, ch
+                        ) == i + count:
+                            slot = (i + count) % nslots
+                            ring[slot * nruns + ring_len[slot]] = pc + 1
+                            ring_len[slot] += 1
+                            npending += 1
+                if result:
+                    break
+                slot = (i + 1) % nslots
+                for j in range(ring_len[slot]):
+                    if addstate(
+                        ptags, parg1, parg2, nlist, &nnlist, on, stack,
+                        ring[slot * nruns + j],
+                    ):
+                        result = True
+                        break
+                npending -= ring_len[slot]
+                ring_len[slot] = 0
+                if result or (nnlist == 0 and npending == 0):
+                    break
+                tmp = clist
+                clist = nlist
+                nlist = tmp
+                nclist = nnlist
+    free(scratch)
+    free(ring_len)
+    free(on)
+    return result